@@ -0,0 +1,459 @@
+import os
+import sys
+import copy
+import json
+import math
+import time
+import shutil
+import numpy as np
+import pandas as pd
+import mysql.connector
+from dotenv import load_dotenv
+
+# Streaming accuracy & drift monitor.
+# Billed costs land as CSV files (columns: call_id, actual_cost) in a local
+# drop folder. Writers should create the file under another name (e.g. .tmp)
+# and rename it to .csv when done; .csv files are also left alone until they
+# are older than one poll interval. Each batch is joined with the logged
+# predictions in call_logs, folded into online statistics and the files are
+# moved to "processed" (or "failed" if unreadable). Calls whose prediction is
+# not logged yet are kept as pending (at most DRIFT_PENDING_MAX) and retried
+# with the next files or every DRIFT_PENDING_RETRY_SECONDS. The
+# statistics and pending calls are saved to a JSON state file after every
+# batch, so a restart neither loses history nor re-freezes the reference.
+# The state records a fingerprint of MODEL_PATH; after a retrain (new .pkl)
+# every segment starts a fresh reference. Run with --reset to start over
+# by hand, e.g. after swapping models some other way.
+
+# Load environment variables
+load_dotenv()
+
+DROP_DIR = os.getenv("BILLING_DROP_DIR", "billing_drop")
+PROCESSED_DIR = os.path.join(DROP_DIR, "processed")
+FAILED_DIR = os.path.join(DROP_DIR, "failed")
+STATE_FILE = os.getenv("DRIFT_STATE_FILE", "drift_state.json")
+POLL_SECONDS = float(os.getenv("DRIFT_POLL_SECONDS", "30"))
+# Unmatched billed calls are dropped after waiting this long for their prediction
+PENDING_MAX_AGE_HOURS = float(os.getenv("DRIFT_PENDING_MAX_AGE_HOURS", "72"))
+# At most this many unmatched calls are kept; the oldest are evicted first
+PENDING_MAX = int(os.getenv("DRIFT_PENDING_MAX", "10000"))
+# Without new files, pending calls are only re-queried this often
+PENDING_RETRY_SECONDS = float(os.getenv("DRIFT_PENDING_RETRY_SECONDS", "600"))
+# Call ids per call_logs lookup query, to stay well under max_allowed_packet
+FETCH_CHUNK_SIZE = int(os.getenv("DRIFT_FETCH_CHUNK_SIZE", "1000"))
+MODEL_PATH = os.getenv("MODEL_PATH", "optimized_voip_cost_model.pkl")
+
+# Exponential decay for the rolling statistics (~1/ALPHA most recent calls)
+ALPHA = float(os.getenv("DRIFT_ALPHA", "0.02"))
+# Number of calls per segment used as the frozen reference before drift checks start
+BASELINE_SIZE = int(os.getenv("DRIFT_BASELINE_SIZE", "200"))
+# Flag when rolling MAE exceeds the reference MAE by this factor
+MAE_RATIO_THRESHOLD = float(os.getenv("DRIFT_MAE_RATIO", "1.5"))
+# Flag when a feature's rolling mean is this many standard errors from the reference mean
+FEATURE_Z_THRESHOLD = float(os.getenv("DRIFT_FEATURE_Z", "4.0"))
+
+FEATURES = ["duration", "latency"]
+PREDICTION_COLUMNS = ["call_id", "duration", "latency", "carrier", "time_of_day", "predicted_cost"]
+
+
+class RunningStats:
+    """Welford mean/variance over every value seen (used for the reference window)."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+    def to_dict(self):
+        return {"n": self.n, "mean": self.mean, "m2": self.m2}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.n, stats.mean, stats.m2 = data["n"], data["mean"], data["m2"]
+        return stats
+
+
+class EWStats:
+    """Exponentially weighted mean/variance, O(1) memory per stream."""
+
+    def __init__(self, alpha=ALPHA):
+        self.alpha = alpha
+        self.n = 0
+        self.mean = 0.0
+        self.var = 0.0
+
+    def update(self, x):
+        self.n += 1
+        if self.n == 1:
+            self.mean = x
+            return
+        delta = x - self.mean
+        incr = self.alpha * delta
+        self.mean += incr
+        self.var = (1 - self.alpha) * (self.var + delta * incr)
+
+    def to_dict(self):
+        return {"alpha": self.alpha, "n": self.n, "mean": self.mean, "var": self.var}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data["alpha"])
+        stats.n, stats.mean, stats.var = data["n"], data["mean"], data["var"]
+        return stats
+
+
+class SegmentMonitor:
+    """Rolling MAE / R² and feature statistics for one carrier × time-of-day segment."""
+
+    def __init__(self):
+        self.abs_error = EWStats()
+        self.sq_error = EWStats()
+        self.actual = EWStats()
+        self.features = {name: EWStats() for name in FEATURES}
+        self.ref_abs_error = RunningStats()
+        self.ref_features = {name: RunningStats() for name in FEATURES}
+
+    def update(self, predicted, actual, feature_values):
+        error = actual - predicted
+        self.abs_error.update(abs(error))
+        self.sq_error.update(error * error)
+        self.actual.update(actual)
+        for name, value in feature_values.items():
+            self.features[name].update(value)
+
+        # Freeze the reference once the baseline window is full
+        if self.ref_abs_error.n < BASELINE_SIZE:
+            self.ref_abs_error.update(abs(error))
+            for name, value in feature_values.items():
+                self.ref_features[name].update(value)
+
+    @property
+    def mae(self):
+        return self.abs_error.mean
+
+    @property
+    def r2(self):
+        if self.actual.var <= 0:
+            return None
+        return 1 - self.sq_error.mean / self.actual.var
+
+    def drift_reasons(self):
+        if self.ref_abs_error.n < BASELINE_SIZE:
+            return []
+
+        reasons = []
+        ref_mae = self.ref_abs_error.mean
+        if ref_mae > 0 and self.mae > ref_mae * MAE_RATIO_THRESHOLD:
+            reasons.append(f"MAE {self.mae:.2f} vs reference {ref_mae:.2f}")
+
+        for name in FEATURES:
+            ref = self.ref_features[name]
+            ew = self.features[name]
+            if ref.std == 0:
+                continue
+            # Standard error of (EW mean - reference mean) under no drift
+            stderr = ref.std * math.sqrt(ew.alpha / (2 - ew.alpha) + 1 / ref.n)
+            z = (ew.mean - ref.mean) / stderr
+            if abs(z) > FEATURE_Z_THRESHOLD:
+                reasons.append(f"{name} mean shifted {z:+.1f} SE ({ref.mean:.1f} → {ew.mean:.1f})")
+        return reasons
+
+    def to_dict(self):
+        return {
+            "abs_error": self.abs_error.to_dict(),
+            "sq_error": self.sq_error.to_dict(),
+            "actual": self.actual.to_dict(),
+            "features": {name: s.to_dict() for name, s in self.features.items()},
+            "ref_abs_error": self.ref_abs_error.to_dict(),
+            "ref_features": {name: s.to_dict() for name, s in self.ref_features.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        monitor = cls()
+        monitor.abs_error = EWStats.from_dict(data["abs_error"])
+        monitor.sq_error = EWStats.from_dict(data["sq_error"])
+        monitor.actual = EWStats.from_dict(data["actual"])
+        monitor.features = {name: EWStats.from_dict(s) for name, s in data["features"].items()}
+        monitor.ref_abs_error = RunningStats.from_dict(data["ref_abs_error"])
+        monitor.ref_features = {name: RunningStats.from_dict(s) for name, s in data["ref_features"].items()}
+        return monitor
+
+
+monitors = {}
+# call_id -> {"actual_cost": float, "first_seen": epoch seconds}
+pending = {}
+# Files folded into the saved state but possibly not yet moved out of DROP_DIR
+last_batch_files = []
+# Fingerprint of the model whose predictions the saved statistics describe
+model_id = None
+last_pending_retry = 0.0
+
+
+def current_model_id():
+    """Cheap fingerprint of the model file (size + mtime); None if it cannot be read."""
+    try:
+        st = os.stat(MODEL_PATH)
+    except OSError:
+        return None
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+
+def load_state(reset=False):
+    """Restore statistics and pending calls; segment references start over when the model changed."""
+    global last_batch_files, model_id
+    model_id = current_model_id()
+    if not os.path.exists(STATE_FILE):
+        return
+    with open(STATE_FILE) as f:
+        state = json.load(f)
+    pending.update({int(call_id): row for call_id, row in state.get("pending", {}).items()})
+    last_batch_files = state.get("last_batch_files", [])
+
+    saved_model_id = state.get("model_id")
+    if reset or (model_id and saved_model_id and saved_model_id != model_id):
+        print(f"🔄 {'Reset requested' if reset else 'Model changed'}: segment statistics start over")
+        return
+    for key, data in state.get("segments", {}).items():
+        carrier, time_of_day = key.split("|", 1)
+        monitors[(carrier, time_of_day)] = SegmentMonitor.from_dict(data)
+    print(f"💾 Restored {len(monitors)} segments and {len(pending)} pending calls from {STATE_FILE}")
+
+
+def save_state(new_monitors, new_pending, batch_files, new_model_id):
+    state = {
+        "model_id": new_model_id,
+        "segments": {f"{carrier}|{tod}": m.to_dict() for (carrier, tod), m in new_monitors.items()},
+        "pending": {str(call_id): row for call_id, row in new_pending.items()},
+        "last_batch_files": batch_files,
+    }
+    # Write atomically so a crash never leaves a half-written state file
+    tmp_path = STATE_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, allow_nan=False)
+    os.replace(tmp_path, STATE_FILE)
+
+
+def connect_db():
+    try:
+        return mysql.connector.connect(
+            host=os.getenv("DB_HOST", "localhost"),
+            user=os.getenv("DB_USER", "root"),
+            password=os.getenv("DB_PASSWORD", "test12"),
+            database=os.getenv("DB_DATABASE", "voip_optimizer"),
+        )
+    except mysql.connector.Error as e:
+        raise RuntimeError(f"❌ Failed to connect to the database: {str(e)}")
+
+
+def fetch_predictions(db, call_ids):
+    """Look up the logged predictions for one batch of billed calls, FETCH_CHUNK_SIZE ids per query."""
+    rows = []
+    cursor = db.cursor()
+    for start in range(0, len(call_ids), FETCH_CHUNK_SIZE):
+        chunk = call_ids[start:start + FETCH_CHUNK_SIZE]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(f"""
+            SELECT id, duration, latency,
+                   COALESCE(carrier, 'UNKNOWN'), COALESCE(time_of_day, 'UNKNOWN'),
+                   predicted_cost
+            FROM call_logs
+            WHERE id IN ({placeholders}) AND predicted_cost IS NOT NULL
+        """, tuple(chunk))
+        rows.extend(cursor.fetchall())
+    cursor.close()
+    return pd.DataFrame(rows, columns=PREDICTION_COLUMNS)
+
+
+def read_billing_file(path):
+    """Load one drop file, keeping only rows with a whole call_id and a finite actual_cost."""
+    billed = pd.read_csv(path)
+    billed.columns = billed.columns.str.strip()  # Remove unwanted spaces
+    billed = billed[["call_id", "actual_cost"]].copy()
+    for column in ["call_id", "actual_cost"]:
+        billed[column] = pd.to_numeric(billed[column], errors="coerce")
+    # NaN and ±inf both fail isfinite; a fractional call_id is not a call we logged
+    billed = billed[np.isfinite(billed).all(axis=1) & (billed["call_id"] % 1 == 0)]
+    billed["call_id"] = billed["call_id"].astype(int)
+    return billed
+
+
+def ready_files():
+    """Drop files that are complete (renamed to .csv, untouched for a poll interval) and not yet counted."""
+    now = time.time()
+    names = []
+    for name in sorted(os.listdir(DROP_DIR)):
+        path = os.path.join(DROP_DIR, name)
+        if name in last_batch_files:
+            continue
+        if name.endswith(".csv") and os.path.isfile(path) and now - os.path.getmtime(path) >= POLL_SECONDS:
+            names.append(name)
+    return names
+
+
+def process_batch(db, names, base_monitors):
+    """Join the given drop files (plus pending calls) with call_logs.
+
+    Works on copies: returns (good_names, new_monitors, new_pending) and leaves the globals untouched,
+    so nothing is counted until the caller has saved the result. Unreadable files are moved to FAILED_DIR.
+    """
+    frames, good_names = [], []
+    for name in names:
+        path = os.path.join(DROP_DIR, name)
+        try:
+            frames.append(read_billing_file(path))
+            good_names.append(name)
+        except Exception as e:
+            print(f"❌ Failed to read {name}, moving to {FAILED_DIR}: {str(e)}")
+            shutil.move(path, os.path.join(FAILED_DIR, name))
+
+    new_monitors = copy.deepcopy(base_monitors)
+    now = time.time()
+    # Pending calls go first so a newer billing row for the same call wins
+    frames.insert(0, pd.DataFrame(
+        [(call_id, row["actual_cost"], row["first_seen"]) for call_id, row in pending.items()],
+        columns=["call_id", "actual_cost", "first_seen"],
+    ))
+    billed = pd.concat(frames, ignore_index=True)
+    if billed.empty:
+        return good_names, new_monitors, {}
+    billed["call_id"] = billed["call_id"].astype(int)
+    billed["first_seen"] = billed["first_seen"].astype(float).fillna(now)
+    # The same call billed twice (within a file, across files or re-billed while pending):
+    # take the latest cost but keep the earliest first_seen so re-billing never postpones expiry
+    first_seen = billed.groupby("call_id")["first_seen"].min()
+    billed = billed.drop_duplicates(subset="call_id", keep="last").copy()
+    billed["first_seen"] = billed["call_id"].map(first_seen)
+
+    # Any DB error propagates before a single monitor is touched
+    predictions = fetch_predictions(db, billed["call_id"].tolist())
+    db.commit()  # End the read transaction so new call_logs rows are visible next poll
+    predictions["call_id"] = predictions["call_id"].astype(int)
+    for column in ["duration", "latency", "predicted_cost"]:
+        predictions[column] = pd.to_numeric(predictions[column], errors="coerce")
+    predictions[["carrier", "time_of_day"]] = predictions[["carrier", "time_of_day"]].fillna("UNKNOWN")
+    # Logged calls with missing features will never become usable, so they are dropped rather than kept pending
+    unusable = ~np.isfinite(predictions[["duration", "latency", "predicted_cost"]].astype(float)).all(axis=1)
+    unusable_ids = predictions.loc[unusable, "call_id"]
+    billed = billed[~billed["call_id"].isin(unusable_ids)]
+    predictions = predictions[~unusable]
+
+    joined = billed.merge(predictions, on="call_id", how="left", indicator=True)
+    matched = joined[joined["_merge"] == "both"]
+    unmatched = joined[joined["_merge"] == "left_only"]
+
+    for row in matched.itertuples(index=False):
+        feature_values = {name: float(getattr(row, name)) for name in FEATURES}
+        for key in [("ALL", "ALL"), (row.carrier, row.time_of_day)]:
+            monitor = new_monitors.setdefault(key, SegmentMonitor())
+            monitor.update(float(row.predicted_cost), float(row.actual_cost), feature_values)
+
+    # Expire calls that waited too long, then keep only the newest PENDING_MAX
+    fresh = unmatched[now - unmatched["first_seen"] <= PENDING_MAX_AGE_HOURS * 3600]
+    kept = fresh.sort_values("first_seen").tail(PENDING_MAX)
+    new_pending = {
+        int(row.call_id): {"actual_cost": float(row.actual_cost), "first_seen": float(row.first_seen)}
+        for row in kept.itertuples(index=False)
+    }
+
+    print(f"📥 {len(good_names)} file(s): {len(matched)} calls matched, {len(new_pending)} pending, "
+          f"{len(unusable_ids)} dropped (missing features), {len(unmatched) - len(kept)} expired/evicted")
+    return good_names, new_monitors, new_pending
+
+
+def report():
+    for (carrier, time_of_day), monitor in sorted(monitors.items()):
+        r2 = monitor.r2
+        r2_text = f"{r2:.2f}" if r2 is not None else "n/a"
+        line = f"{carrier:>10} | {time_of_day:<9} | n={monitor.abs_error.n:<6} MAE={monitor.mae:.2f} R²={r2_text}"
+        reasons = monitor.drift_reasons()
+        if reasons:
+            print(f"⚠️  {line} | DRIFT: {'; '.join(reasons)}")
+        else:
+            print(f"✅ {line}")
+
+
+def move_processed(names):
+    for name in names:
+        path = os.path.join(DROP_DIR, name)
+        if os.path.exists(path):
+            shutil.move(path, os.path.join(PROCESSED_DIR, name))
+
+
+def finish_last_batch():
+    """Move the last saved batch's files out of DROP_DIR, then forget them so a reused file name is read again."""
+    global last_batch_files
+    if not last_batch_files:
+        return
+    move_processed(last_batch_files)
+    save_state(monitors, pending, [], model_id)
+    last_batch_files = []
+
+
+def poll(db):
+    """One poll: process ready files (and pending calls when due), save, then commit the result in memory.
+
+    Raises on any failure; the in-memory statistics only change after the new state is saved.
+    """
+    global model_id, last_batch_files, last_pending_retry
+
+    # Finish the previous batch first; its files are already counted in the saved state
+    finish_last_batch()
+
+    names = ready_files()
+    now = time.time()
+    retry_pending = bool(pending) and now - last_pending_retry >= PENDING_RETRY_SECONDS
+    if not names and not retry_pending:
+        return
+
+    new_model_id = current_model_id()
+    base_monitors = monitors
+    if model_id and new_model_id and new_model_id != model_id:
+        print("🔄 Model changed: segment statistics start over")
+        base_monitors = {}
+
+    db.ping(reconnect=True, attempts=3, delay=5)
+    done, new_monitors, new_pending = process_batch(db, names, base_monitors)
+    save_state(new_monitors, new_pending, done, new_model_id)
+
+    monitors.clear()
+    monitors.update(new_monitors)
+    pending.clear()
+    pending.update(new_pending)
+    model_id = new_model_id
+    last_batch_files = done
+    last_pending_retry = now
+
+    finish_last_batch()
+    report()
+
+
+def run(reset=False):
+    os.makedirs(PROCESSED_DIR, exist_ok=True)
+    os.makedirs(FAILED_DIR, exist_ok=True)
+    load_state(reset)
+    db = connect_db()
+    print(f"👀 Watching {DROP_DIR} for billed cost files...")
+
+    while True:
+        try:
+            poll(db)
+        except Exception as e:
+            print(f"❌ Poll failed, will retry next poll: {str(e)}")
+
+        time.sleep(POLL_SECONDS)
+
+
+if __name__ == "__main__":
+    run(reset="--reset" in sys.argv)
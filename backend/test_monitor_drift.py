@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import monitor_drift
+from monitor_drift import RunningStats, EWStats, SegmentMonitor, BASELINE_SIZE
+
+rng = np.random.default_rng(42)
+
+# Welford mean/std must match numpy on a fixed sample
+sample = rng.normal(300, 100, 5000)
+running = RunningStats()
+for x in sample:
+    running.update(x)
+assert np.isclose(running.mean, sample.mean()), (running.mean, sample.mean())
+assert np.isclose(running.std, sample.std(ddof=1)), (running.std, sample.std(ddof=1))
+print(f"✅ Welford mean={running.mean:.2f} std={running.std:.2f} matches numpy")
+
+# EW mean/variance must match pandas' recursive (adjust=False) EWM
+alpha = 0.02
+ew = EWStats(alpha)
+for x in sample:
+    ew.update(x)
+ewm = pd.Series(sample).ewm(alpha=alpha, adjust=False)
+assert np.isclose(ew.mean, ewm.mean().iloc[-1]), (ew.mean, ewm.mean().iloc[-1])
+assert np.isclose(ew.var, ewm.var(bias=True).iloc[-1]), (ew.var, ewm.var(bias=True).iloc[-1])
+print(f"✅ EW mean={ew.mean:.2f} var={ew.var:.2f} matches pandas")
+
+
+def feed(monitor, n, duration_mean=300, error_std=1.0):
+    for _ in range(n):
+        actual = rng.uniform(1, 50)
+        predicted = actual + rng.normal(0, error_std)
+        monitor.update(predicted, actual, {
+            "duration": rng.normal(duration_mean, 100),
+            "latency": rng.normal(200, 20),
+        })
+
+
+# A stable stream must not be flagged
+stable = SegmentMonitor()
+feed(stable, 4000)
+assert stable.drift_reasons() == [], stable.drift_reasons()
+print(f"✅ Stable stream: MAE={stable.mae:.2f} R²={stable.r2:.2f}, no drift")
+
+# No drift checks before the reference window is full
+young = SegmentMonitor()
+feed(young, BASELINE_SIZE - 1, error_std=10.0)
+assert young.drift_reasons() == []
+
+# A sustained MAE regression must be flagged
+regressed = SegmentMonitor()
+feed(regressed, 2000)
+feed(regressed, 2000, error_std=5.0)
+reasons = regressed.drift_reasons()
+assert any(r.startswith("MAE") for r in reasons), reasons
+print(f"✅ MAE regression flagged: {reasons}")
+
+# A sustained feature shift (here 2σ in duration) must be flagged
+shifted = SegmentMonitor()
+feed(shifted, 2000)
+feed(shifted, 2000, duration_mean=500)
+reasons = shifted.drift_reasons()
+assert any(r.startswith("duration") for r in reasons), reasons
+assert not any(r.startswith("MAE") for r in reasons), reasons
+print(f"✅ Feature shift flagged: {reasons}")
+
+# Saved state must round-trip exactly
+restored = SegmentMonitor.from_dict(shifted.to_dict())
+assert restored.to_dict() == shifted.to_dict()
+assert restored.drift_reasons() == shifted.drift_reasons()
+print("✅ State round-trips through to_dict/from_dict")
+
+# ---- Batch processing against a fake call_logs table and a temp drop folder ----
+work_dir = tempfile.mkdtemp()
+monitor_drift.DROP_DIR = os.path.join(work_dir, "billing_drop")
+monitor_drift.PROCESSED_DIR = os.path.join(monitor_drift.DROP_DIR, "processed")
+monitor_drift.FAILED_DIR = os.path.join(monitor_drift.DROP_DIR, "failed")
+monitor_drift.STATE_FILE = os.path.join(work_dir, "drift_state.json")
+monitor_drift.MODEL_PATH = os.path.join(work_dir, "model.pkl")
+monitor_drift.POLL_SECONDS = 0
+os.makedirs(monitor_drift.PROCESSED_DIR)
+os.makedirs(monitor_drift.FAILED_DIR)
+with open(monitor_drift.MODEL_PATH, "wb") as f:
+    f.write(b"model v1")
+
+# id -> (duration, latency, carrier, time_of_day, predicted_cost); NULL carrier is mapped by COALESCE in SQL,
+# the fake returns it raw to exercise the pandas fallback as well
+call_logs = {
+    1: (100, 200, "Carrier A", "Morning", 5.0),
+    2: (120, None, "Carrier B", "Night", 6.0),
+    3: (90, 150, None, None, 4.0),
+    6: (80, 120, "Carrier A", "Morning", 3.0),
+}
+queries = []
+
+
+class FakeCursor:
+    def execute(self, query, params):
+        queries.append(params)
+        self.rows = [(i,) + call_logs[i] for i in params if i in call_logs and call_logs[i][4] is not None]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeDB:
+    def cursor(self):
+        return FakeCursor()
+
+    def ping(self, **kwargs):
+        pass
+
+    def commit(self):
+        pass
+
+
+db = FakeDB()
+
+
+def drop(name, text):
+    with open(os.path.join(monitor_drift.DROP_DIR, name), "w") as f:
+        f.write(text)
+
+
+def restart():
+    monitor_drift.monitors.clear()
+    monitor_drift.pending.clear()
+    monitor_drift.last_batch_files = []
+    monitor_drift.last_pending_retry = 0.0
+    monitor_drift.load_state()
+
+
+def total_n():
+    overall = monitor_drift.monitors.get(("ALL", "ALL"))
+    return overall.abs_error.n if overall else 0
+
+
+monitor_drift.load_state()
+
+# Cleaning, dedup, NULL features, UNKNOWN labels, unmatched -> pending, unreadable -> failed/
+drop("a.csv", "call_id,actual_cost\n1,5.5\n1,5.7\n2,6.1\n3,abc\n3,4.2\n4,7.0\nx,1\n6,inf\n1.5,2.0\n")
+drop("bad.csv", "foo\n1\n")
+drop("b.tmp", "call_id,actual_cost\n9,1\n")
+monitor_drift.poll(db)
+assert total_n() == 2, total_n()  # calls 1 and 3 only
+assert np.isclose(monitor_drift.monitors[("Carrier A", "Morning")].mae, 0.7)  # latest billing row for call 1 wins
+assert ("UNKNOWN", "UNKNOWN") in monitor_drift.monitors
+assert list(monitor_drift.pending) == [4], monitor_drift.pending
+assert os.listdir(monitor_drift.FAILED_DIR) == ["bad.csv"]
+assert os.listdir(monitor_drift.PROCESSED_DIR) == ["a.csv"]
+assert sorted(os.listdir(monitor_drift.DROP_DIR)) == ["b.tmp", "failed", "processed"]
+with open(monitor_drift.STATE_FILE) as f:
+    state = json.load(f)  # would fail on NaN/Infinity written by json.dump
+assert state["last_batch_files"] == []
+print("✅ Batch cleaning, dedup, UNKNOWN mapping, pending and failed/ handling")
+
+# Re-billing a pending call updates its cost but keeps its first_seen
+first_seen = monitor_drift.pending[4]["first_seen"]
+time.sleep(0.01)
+drop("a.csv", "call_id,actual_cost\n4,7.5\n")  # reused file name must be read again
+monitor_drift.poll(db)
+assert monitor_drift.pending[4] == {"actual_cost": 7.5, "first_seen": first_seen}, monitor_drift.pending
+print("✅ Re-billed pending call keeps its first_seen")
+
+# Without new files, pending calls wait for the retry interval
+queries.clear()
+monitor_drift.poll(db)
+assert queries == []
+
+# Pending survives a restart and is matched once the prediction is logged
+restart()
+call_logs[4] = (60, 180, "Carrier C", "Evening", 6.5)
+monitor_drift.poll(db)
+assert total_n() == 3 and monitor_drift.pending == {}
+print("✅ Pending call restored after restart and matched later")
+
+# Pending is capped (oldest evicted) and ids are queried in fixed-size chunks
+monitor_drift.PENDING_MAX, monitor_drift.FETCH_CHUNK_SIZE = 3, 2
+drop("c.csv", "call_id,actual_cost\n" + "".join(f"{i},1.0\n" for i in range(100, 105)))
+queries.clear()
+monitor_drift.poll(db)
+assert len(monitor_drift.pending) == 3, monitor_drift.pending
+assert len(queries) == 3 and max(len(q) for q in queries) == 2, queries
+monitor_drift.pending.clear()
+print("✅ Pending capped and lookups chunked")
+
+# Regression: a failed save must not leave the batch counted in memory
+call_logs[5] = (70, 160, "Carrier D", "Night", 2.0)
+drop("d.csv", "call_id,actual_cost\n5,2.5\n")
+before = total_n()
+real_save_state = monitor_drift.save_state
+
+
+def failing_save_state(*args):
+    raise OSError("disk full")
+
+
+monitor_drift.save_state = failing_save_state
+try:
+    monitor_drift.poll(db)
+    raise AssertionError("poll should have failed")
+except OSError:
+    pass
+monitor_drift.save_state = real_save_state
+assert total_n() == before, total_n()
+monitor_drift.poll(db)
+assert total_n() == before + 1, total_n()
+restart()
+assert total_n() == before + 1, total_n()
+print("✅ Failed save does not double count")
+
+# A failed move after a successful save must not re-read the file on the next poll
+drop("f.csv", "call_id,actual_cost\n5,2.6\n")
+before = total_n()
+real_move_processed = monitor_drift.move_processed
+
+
+def failing_move_processed(names):
+    raise OSError("permission denied")
+
+
+monitor_drift.move_processed = failing_move_processed
+try:
+    monitor_drift.poll(db)
+    raise AssertionError("poll should have failed")
+except OSError:
+    pass
+monitor_drift.move_processed = real_move_processed
+assert total_n() == before + 1, total_n()
+monitor_drift.poll(db)
+assert total_n() == before + 1, total_n()
+assert "f.csv" in os.listdir(monitor_drift.PROCESSED_DIR)
+print("✅ Failed move does not double count")
+
+# A new model file resets the segment statistics
+with open(monitor_drift.MODEL_PATH, "wb") as f:
+    f.write(b"model v2, retrained")
+drop("e.csv", "call_id,actual_cost\n6,3.2\n")
+monitor_drift.poll(db)
+assert total_n() == 1, total_n()
+restart()
+assert total_n() == 1, total_n()
+print("✅ Retrained model starts fresh references")